@@ -1,24 +1,35 @@
 import os
 import uuid
+import asyncio
 from typing import List, Optional
 from pathlib import Path
 import shutil
+import threading
 
 import torch
 import numpy as np
 from fastapi import FastAPI, File, UploadFile, HTTPException, Query
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
 from colpali_engine.models import ColPali, ColPaliProcessor
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 from PIL import Image
 from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, PointStruct, Filter, FieldCondition, MatchValue
+from qdrant_client.models import (
+    Distance, VectorParams, PointStruct, Filter, FieldCondition, MatchValue,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType, PayloadSchemaType, PointIdsList
+)
 import logging
 
-# Configure logs
-logging.basicConfig(level=logging.INFO)
+# Configure logs, falling back to INFO if LOG_LEVEL is not a known level name
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+log_level_valid = isinstance(logging.getLevelName(LOG_LEVEL), int)
+logging.basicConfig(level=LOG_LEVEL if log_level_valid else logging.INFO)
 logger = logging.getLogger(__name__)
+if not log_level_valid:
+    logger.warning(f"Unknown LOG_LEVEL '{LOG_LEVEL}', falling back to INFO")
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -27,11 +38,15 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Compress larger JSON responses such as /documents for clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
 # Global variables for model and clients
 model = None
 processor = None
 qdrant_client = None
 device = None
+model_lock = threading.Lock()  # Serializes forward passes from concurrent requests
 
 # Configuration
 # For local Qdrant: QDRANT_HOST=qdrant, QDRANT_PORT=6333
@@ -40,8 +55,20 @@ QDRANT_URL = os.getenv("QDRANT_URL", None)  # Full URL for Qdrant Cloud (e.g., h
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", None)  # API key for Qdrant Cloud
 QDRANT_HOST = os.getenv("QDRANT_HOST", "qdrant")  # For local Qdrant
 QDRANT_PORT = int(os.getenv("QDRANT_PORT", "6333"))  # For local Qdrant
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+# gRPC is faster than REST for upserts. Unset: gRPC for local Qdrant, REST for QDRANT_URL (proxies may only forward 6333)
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC")
+QDRANT_UPSERT_BATCH_SIZE = int(os.getenv("QDRANT_UPSERT_BATCH_SIZE", "256"))  # Points per upsert request
+SCROLL_PAGE_SIZE = 1000  # Points fetched per scroll request when listing documents
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "colpali-test")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "4"))  # Pages per forward pass
+PDF_RENDER_THREADS = int(os.getenv("PDF_RENDER_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))  # Parallel pdftoppm processes
+# Pages rendered per pdftoppm call: enough to keep every render process busy, rounded up to a
+# multiple of EMBEDDING_BATCH_SIZE so each chunk splits into full forward-pass batches
+PDF_RENDER_CHUNK_SIZE = -(-max(EMBEDDING_BATCH_SIZE, PDF_RENDER_THREADS * 2) // EMBEDDING_BATCH_SIZE) * EMBEDDING_BATCH_SIZE
 UPLOAD_DIR = Path("/app/uploads")
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB copy buffer when saving uploads
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp')
 UPLOAD_DIR.mkdir(exist_ok=True)
 
 # Pydantic models
@@ -106,12 +133,19 @@ async def startup_event():
                 qdrant_client = QdrantClient(
                     url=QDRANT_URL,
                     api_key=QDRANT_API_KEY,
+                    grpc_port=QDRANT_GRPC_PORT,
+                    prefer_grpc=QDRANT_PREFER_GRPC is not None and QDRANT_PREFER_GRPC.lower() == "true",
                     timeout=30
                 )
             else:
                 # Use local Qdrant
                 logger.info(f"Connecting to local Qdrant at {QDRANT_HOST}:{QDRANT_PORT}...")
-                qdrant_client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
+                qdrant_client = QdrantClient(
+                    host=QDRANT_HOST,
+                    port=QDRANT_PORT,
+                    grpc_port=QDRANT_GRPC_PORT,
+                    prefer_grpc=QDRANT_PREFER_GRPC is None or QDRANT_PREFER_GRPC.lower() == "true"
+                )
 
             # Create collection if it doesn't exist
             collections = qdrant_client.get_collections().collections
@@ -121,12 +155,29 @@ async def startup_event():
                 logger.info(f"Creating collection: {COLLECTION_NAME}")
                 # ColPali generates embeddings with dimension 128 per token
                 # We'll store the average pooled embedding for each page
+                # INT8 quantization keeps a 4x smaller copy of the vectors in RAM for search
                 qdrant_client.create_collection(
                     collection_name=COLLECTION_NAME,
-                    vectors_config=VectorParams(size=128, distance=Distance.COSINE)
+                    vectors_config=VectorParams(size=128, distance=Distance.COSINE),
+                    quantization_config=ScalarQuantization(
+                        scalar=ScalarQuantizationConfig(type=ScalarType.INT8, always_ram=True)
+                    )
                 )
             else:
                 logger.info(f"Collection '{COLLECTION_NAME}' already exists")
+
+            # Index the payload fields used in filters so deletes and listings avoid full scans
+            # (creating an index that already exists is a no-op)
+            qdrant_client.create_payload_index(
+                collection_name=COLLECTION_NAME,
+                field_name="document_id",
+                field_schema=PayloadSchemaType.KEYWORD
+            )
+            qdrant_client.create_payload_index(
+                collection_name=COLLECTION_NAME,
+                field_name="page_number",
+                field_schema=PayloadSchemaType.INTEGER
+            )
             logger.info("Qdrant connected successfully!")
             break  # Success, exit retry loop
         except Exception as e:
@@ -137,6 +188,37 @@ async def startup_event():
             else:
                 raise
 
+def embed_images(images: List[Image.Image]) -> np.ndarray:
+    """Generate ColPali embeddings for a batch of images in a single forward pass"""
+    batch_images = processor.process_images(images).to(device)
+
+    with model_lock, torch.no_grad():
+        embeddings = model(**batch_images)
+
+    return embeddings.cpu().numpy()
+
+def save_upload(file_obj, file_path: Path):
+    """Copy an uploaded file to disk"""
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(file_obj, buffer, UPLOAD_CHUNK_SIZE)
+
+def load_image(file_obj) -> Image.Image:
+    """Open an uploaded image and convert it to RGB if necessary"""
+    image = Image.open(file_obj)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+def render_pdf_pages(file_path: Path, first_page: int, last_page: int) -> List[Image.Image]:
+    """Render a range of PDF pages to images using parallel pdftoppm processes"""
+    return convert_from_path(
+        str(file_path),
+        dpi=200,
+        first_page=first_page,
+        last_page=last_page,
+        thread_count=PDF_RENDER_THREADS
+    )
+
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
     """Health check endpoint"""
@@ -165,92 +247,125 @@ async def ingest_pdf(
     # Save uploaded file
     file_path = UPLOAD_DIR / f"{document_id}_{file.filename}"
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        await run_in_threadpool(save_upload, file.file, file_path)
         logger.info(f"Saved file: {file_path}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
 
+    next_render = None
+    written_point_ids = []  # Points sent to Qdrant so far, removed again if the ingest fails
     try:
-        # Convert PDF to images
-        logger.info(f"Converting PDF to images: {file_path}")
-        pages = convert_from_path(str(file_path), dpi=200)
-        logger.info(f"Extracted {len(pages)} pages")
+        # Read the page count up front; pages are rendered chunk by chunk below
+        pdf_info = await run_in_threadpool(pdfinfo_from_path, str(file_path))
+        total_pages = pdf_info["Pages"]
+        logger.info(f"Converting {total_pages} PDF pages to images: {file_path}")
 
         # Process each page and store embeddings
         points = []
         embedding_dim = None
         tokens_per_page = None
 
-        for page_num, page_image in enumerate(pages, 1):
-            logger.info(f"-" * 60)
-            logger.info(f"PAGE {page_num} of {len(pages)}")
-            logger.info(f"-" * 60)
-            logger.info(f"  Image size: {page_image.size}")
-            logger.info(f"  ⏳ Generating embeddings...")
-
-            # Generate embeddings (same as app.py)
-            batch_images = processor.process_images([page_image]).to(device)
-
-            with torch.no_grad():
-                embeddings = model(**batch_images)
-
-            embeddings_np = embeddings.cpu().numpy()[0]
-            tokens_per_page = embeddings_np.shape[0]
-
-            # Display embedding info (same as app.py)
-            logger.info(f"\n  EMBEDDING RESULTS:")
-            logger.info(f"    Shape: {embeddings_np.shape}")
-            logger.info(f"    Number of tokens/patches: {embeddings_np.shape[0]}")
-            logger.info(f"    Embedding dimension: {embeddings_np.shape[1]}")
-            logger.info(f"    Min value: {embeddings_np.min():.6f}")
-            logger.info(f"    Max value: {embeddings_np.max():.6f}")
-            logger.info(f"    Mean value: {embeddings_np.mean():.6f}")
-            logger.info(f"    Std deviation: {embeddings_np.std():.6f}")
-
-            # Average pool the embeddings (from multiple tokens to single vector)
-            avg_embedding = embeddings_np.mean(axis=0)
-            embedding_dim = avg_embedding.shape[0]
-            logger.info(f"    Average pooled embedding dimension: {embedding_dim}")
-
-            # Create point for Qdrant (use UUID for point ID)
-            point_id = str(uuid.uuid4())
-            point = PointStruct(
-                id=point_id,
-                vector=avg_embedding.tolist(),
-                payload={
-                    "document_id": document_id,
-                    "filename": file.filename,
-                    "page_number": page_num,
-                    "total_pages": len(pages),
-                    "file_type": "pdf",
-                    "tokens_per_page": tokens_per_page,
-                    "embedding_dimension": embedding_dim
-                }
-            )
-            points.append(point)
+        # Render one chunk at a time so memory is bounded by the chunk size, not the page count,
+        # and start rendering the next chunk while the current one is embedded
+        if total_pages > 0:
+            next_render = asyncio.ensure_future(run_in_threadpool(
+                render_pdf_pages, file_path, 1, min(PDF_RENDER_CHUNK_SIZE, total_pages)
+            ))
+        for chunk_start in range(0, total_pages, PDF_RENDER_CHUNK_SIZE):
+            chunk_pages = await next_render
+            next_start = chunk_start + PDF_RENDER_CHUNK_SIZE
+            if next_start < total_pages:
+                next_render = asyncio.ensure_future(run_in_threadpool(
+                    render_pdf_pages, file_path, next_start + 1, min(next_start + PDF_RENDER_CHUNK_SIZE, total_pages)
+                ))
+
+            for batch_offset in range(0, len(chunk_pages), EMBEDDING_BATCH_SIZE):
+                batch_pages = chunk_pages[batch_offset:batch_offset + EMBEDDING_BATCH_SIZE]
+                batch_start = chunk_start + batch_offset
+                logger.info(f"  ⏳ Generating embeddings for pages {batch_start + 1}-{batch_start + len(batch_pages)}...")
+
+                # Generate embeddings for the whole batch in one forward pass
+                batch_embeddings = await run_in_threadpool(embed_images, batch_pages)
+
+                for page_num, page_image, embeddings_np in zip(
+                    range(batch_start + 1, batch_start + len(batch_pages) + 1), batch_pages, batch_embeddings
+                ):
+                    tokens_per_page = embeddings_np.shape[0]
+                    logger.info(
+                        f"PAGE {page_num} of {total_pages}: image size {page_image.size}, "
+                        f"embeddings shape {embeddings_np.shape}"
+                    )
+
+                    # Display detailed embedding info (same as app.py); the stats scan the whole array
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("  EMBEDDING RESULTS:")
+                        logger.debug(f"    Number of tokens/patches: {embeddings_np.shape[0]}")
+                        logger.debug(f"    Embedding dimension: {embeddings_np.shape[1]}")
+                        logger.debug(f"    Min value: {embeddings_np.min():.6f}")
+                        logger.debug(f"    Max value: {embeddings_np.max():.6f}")
+                        logger.debug(f"    Mean value: {embeddings_np.mean():.6f}")
+                        logger.debug(f"    Std deviation: {embeddings_np.std():.6f}")
+
+                    # Average pool the embeddings (from multiple tokens to single vector)
+                    avg_embedding = embeddings_np.mean(axis=0)
+                    embedding_dim = avg_embedding.shape[0]
+
+                    # Create point for Qdrant (use UUID for point ID)
+                    point_id = str(uuid.uuid4())
+                    point = PointStruct(
+                        id=point_id,
+                        vector=avg_embedding.tolist(),
+                        payload={
+                            "document_id": document_id,
+                            "filename": file.filename,
+                            "page_number": page_num,
+                            "total_pages": total_pages,
+                            "file_type": "pdf",
+                            "tokens_per_page": tokens_per_page,
+                            "embedding_dimension": embedding_dim
+                        }
+                    )
+                    points.append(point)
 
         # Upload to Qdrant
         logger.info(f"Uploading {len(points)} embeddings to Qdrant...")
-        qdrant_client.upsert(
-            collection_name=COLLECTION_NAME,
-            points=points
-        )
+        for batch_start in range(0, len(points), QDRANT_UPSERT_BATCH_SIZE):
+            batch_points = points[batch_start:batch_start + QDRANT_UPSERT_BATCH_SIZE]
+            # Record the IDs before the call so a batch that fails after being applied is still cleaned up
+            written_point_ids.extend(point.id for point in batch_points)
+            await run_in_threadpool(
+                qdrant_client.upsert,
+                collection_name=COLLECTION_NAME,
+                points=batch_points
+            )
         logger.info("Upload to Qdrant completed!")
 
         return EmbeddingResponse(
             document_id=document_id,
             filename=file.filename,
-            total_pages=len(pages),
+            total_pages=total_pages,
             embedding_dimension=embedding_dim,
             tokens_per_page=tokens_per_page,
-            message=f"Successfully ingested PDF with {len(pages)} pages"
+            message=f"Successfully ingested PDF with {total_pages} pages"
         )
 
     except Exception as e:
         logger.error(f"Error processing document: {e}")
+        # Remove any batches already written so a failed ingest does not leave a partial document
+        if written_point_ids:
+            try:
+                await run_in_threadpool(
+                    qdrant_client.delete,
+                    collection_name=COLLECTION_NAME,
+                    points_selector=PointIdsList(points=written_point_ids)
+                )
+            except Exception as cleanup_error:
+                logger.error(f"Failed to remove partially ingested document {document_id}: {cleanup_error}")
         raise HTTPException(status_code=500, detail=f"Failed to process document: {str(e)}")
     finally:
+        # Let a prefetched render finish before its input file is removed
+        if next_render is not None:
+            await asyncio.gather(next_render, return_exceptions=True)
         # Clean up uploaded file
         if file_path.exists():
             file_path.unlink()
@@ -263,43 +378,24 @@ async def ingest_image(
     """
     Ingest an image file: generate embeddings and store in Qdrant
     """
-    allowed_extensions = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp')
-    if not file.filename.lower().endswith(allowed_extensions):
+    if not file.filename.lower().endswith(IMAGE_EXTENSIONS):
         raise HTTPException(
             status_code=400,
-            detail=f"Only image files are supported: {', '.join(allowed_extensions)}"
+            detail=f"Only image files are supported: {', '.join(IMAGE_EXTENSIONS)}"
         )
 
     # Generate document ID if not provided
     if document_id is None:
         document_id = str(uuid.uuid4())
 
-    # Save uploaded file
-    file_path = UPLOAD_DIR / f"{document_id}_{file.filename}"
-    try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        logger.info(f"Saved file: {file_path}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
-
     try:
-        # Load image
-        logger.info(f"Loading image: {file_path}")
-        image = Image.open(file_path)
-
-        # Convert to RGB if necessary
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        # Load image straight from the upload stream; PIL does not need it staged on disk
+        logger.info(f"Loading image: {file.filename}")
+        image = await run_in_threadpool(load_image, file.file)
 
         # Generate embeddings
         logger.info("Generating embeddings...")
-        batch_images = processor.process_images([image]).to(device)
-
-        with torch.no_grad():
-            embeddings = model(**batch_images)
-
-        embeddings_np = embeddings.cpu().numpy()[0]
+        embeddings_np = (await run_in_threadpool(embed_images, [image]))[0]
         tokens_per_page = embeddings_np.shape[0]
 
         # Average pool the embeddings
@@ -324,7 +420,8 @@ async def ingest_image(
 
         # Upload to Qdrant
         logger.info("Uploading embedding to Qdrant...")
-        qdrant_client.upsert(
+        await run_in_threadpool(
+            qdrant_client.upsert,
             collection_name=COLLECTION_NAME,
             points=[point]
         )
@@ -342,13 +439,9 @@ async def ingest_image(
     except Exception as e:
         logger.error(f"Error processing image: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to process image: {str(e)}")
-    finally:
-        # Clean up uploaded file
-        if file_path.exists():
-            file_path.unlink()
 
 @app.delete("/document/{document_id}")
-async def delete_document(document_id: str):
+def delete_document(document_id: str):
     """
     Delete all embeddings for a specific document
     """
@@ -373,30 +466,47 @@ async def delete_document(document_id: str):
         raise HTTPException(status_code=500, detail=f"Failed to delete document: {str(e)}")
 
 @app.get("/documents", response_model=List[DocumentInfo])
-async def list_documents():
+def list_documents():
     """
     List all unique documents in the collection
     """
     try:
-        # Scroll through all points to get unique document IDs
-        scroll_result = qdrant_client.scroll(
-            collection_name=COLLECTION_NAME,
-            limit=10000,
-            with_payload=True,
-            with_vectors=False
+        # Only fetch the first page of each document; every document has exactly one
+        first_page_filter = Filter(
+            must=[
+                FieldCondition(
+                    key="page_number",
+                    match=MatchValue(value=1)
+                )
+            ]
         )
 
-        # Extract unique documents
+        # Scroll page by page so large collections are neither truncated nor fetched in one response
         documents = {}
-        for point in scroll_result[0]:
-            doc_id = point.payload["document_id"]
-            if doc_id not in documents:
-                documents[doc_id] = DocumentInfo(
-                    document_id=doc_id,
-                    filename=point.payload["filename"],
-                    total_pages=point.payload["total_pages"],
-                    embedding_dimension=point.payload["embedding_dimension"]
-                )
+        offset = None
+        while True:
+            points, offset = qdrant_client.scroll(
+                collection_name=COLLECTION_NAME,
+                scroll_filter=first_page_filter,
+                limit=SCROLL_PAGE_SIZE,
+                offset=offset,
+                with_payload=["document_id", "filename", "total_pages", "embedding_dimension"],
+                with_vectors=False
+            )
+
+            # Extract unique documents
+            for point in points:
+                doc_id = point.payload["document_id"]
+                if doc_id not in documents:
+                    documents[doc_id] = DocumentInfo(
+                        document_id=doc_id,
+                        filename=point.payload["filename"],
+                        total_pages=point.payload["total_pages"],
+                        embedding_dimension=point.payload["embedding_dimension"]
+                    )
+
+            if offset is None:
+                break
 
         return list(documents.values())
 
@@ -405,7 +515,7 @@ async def list_documents():
         raise HTTPException(status_code=500, detail=f"Failed to list documents: {str(e)}")
 
 @app.get("/stats")
-async def get_stats():
+def get_stats():
     """
     Get collection statistics
     """
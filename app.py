@@ -7,12 +7,10 @@ from pathlib import Path
 import json
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-def extract_and_embed_pdf(pdf_path, output_dir="./embeddings"):
-    print("=" * 60)
-    print("ColPali PDF Embedding Extractor (Docker)")
-    print("=" * 60)
-    
+def load_model():
+    """Load the ColPali model and processor once so they can be reused across PDFs"""
     # Check device
     device = "cuda" if torch.cuda.is_available() else "cpu"
     print(f"\n✓ Using device: {device}")
@@ -32,6 +30,24 @@ def extract_and_embed_pdf(pdf_path, output_dir="./embeddings"):
     processor = ColPaliProcessor.from_pretrained(model_name)
     print("✓ Model loaded successfully!")
     
+    return model, processor, device
+
+def render_pdf(pdf_path):
+    """Convert every page of a PDF to a PIL image"""
+    # In Docker, poppler is already installed and in PATH
+    # Render page ranges in parallel pdftoppm processes to use more than one core
+    return convert_from_path(pdf_path, dpi=200, thread_count=max(1, (os.cpu_count() or 2) // 2))
+
+def extract_and_embed_pdf(pdf_path, output_dir="./embeddings", model=None, processor=None, device=None,
+                          pages_future=None):
+    print("=" * 60)
+    print("ColPali PDF Embedding Extractor (Docker)")
+    print("=" * 60)
+    
+    # Load model only if the caller did not pass a preloaded one
+    if model is None or processor is None:
+        model, processor, device = load_model()
+    
     # Convert PDF to images
     print("\n" + "=" * 60)
     print(f"Processing PDF: {pdf_path}")
@@ -39,8 +55,8 @@ def extract_and_embed_pdf(pdf_path, output_dir="./embeddings"):
     
     print("\n⏳ Converting PDF pages to images...")
     try:
-        # In Docker, poppler is already installed and in PATH
-        pages = convert_from_path(pdf_path, dpi=200)
+        # Use pages rendered ahead of time in the background if the caller started that
+        pages = pages_future.result() if pages_future is not None else render_pdf(pdf_path)
         print(f"✓ Extracted {len(pages)} pages")
     except Exception as e:
         print(f"✗ Error converting PDF: {e}")
@@ -65,16 +81,24 @@ def extract_and_embed_pdf(pdf_path, output_dir="./embeddings"):
         
         embeddings_np = embeddings.cpu().numpy()[0]
         
+        # Compute stats once; they are both displayed and saved in the metadata
+        stats = {
+            'min': float(embeddings_np.min()),
+            'max': float(embeddings_np.max()),
+            'mean': float(embeddings_np.mean()),
+            'std': float(embeddings_np.std())
+        }
+        
         # Display embedding info
         print(f"\n  EMBEDDING RESULTS:")
         print(f"    Shape: {embeddings_np.shape}")
         print(f"    Number of tokens/patches: {embeddings_np.shape[0]}")
         print(f"    Embedding dimension: {embeddings_np.shape[1]}")
         print(f"    Data type: {embeddings_np.dtype}")
-        print(f"    Min value: {embeddings_np.min():.6f}")
-        print(f"    Max value: {embeddings_np.max():.6f}")
-        print(f"    Mean value: {embeddings_np.mean():.6f}")
-        print(f"    Std deviation: {embeddings_np.std():.6f}")
+        print(f"    Min value: {stats['min']:.6f}")
+        print(f"    Max value: {stats['max']:.6f}")
+        print(f"    Mean value: {stats['mean']:.6f}")
+        print(f"    Std deviation: {stats['std']:.6f}")
         
         # Show first few token embeddings
         print(f"\n  FIRST 3 TOKEN EMBEDDINGS (first 10 dimensions):")
@@ -92,12 +116,7 @@ def extract_and_embed_pdf(pdf_path, output_dir="./embeddings"):
             'shape': embeddings_np.shape,
             'embeddings': embeddings_np,
             'avg_embedding': avg_embedding,
-            'stats': {
-                'min': float(embeddings_np.min()),
-                'max': float(embeddings_np.max()),
-                'mean': float(embeddings_np.mean()),
-                'std': float(embeddings_np.std())
-            }
+            'stats': stats
         })
     
     # Save embeddings
@@ -152,6 +171,11 @@ def extract_and_embed_pdf(pdf_path, output_dir="./embeddings"):
     
     return all_embeddings
 
+def is_up_to_date(pdf_path, output_dir):
+    """Check whether a PDF was already embedded and has not changed since"""
+    metadata_file = Path(output_dir) / f"{Path(pdf_path).stem}_metadata.json"
+    return metadata_file.exists() and metadata_file.stat().st_mtime >= Path(pdf_path).stat().st_mtime
+
 def main():
     # Check for PDF files in /app/pdfs
     pdf_dir = Path("/app/pdfs")
@@ -181,11 +205,31 @@ def main():
         else:
             print(f"Error: PDF not found: {pdf_name}")
     else:
-        # Process all PDFs
+        # Skip PDFs whose embeddings are newer than the PDF itself
+        pending_files = []
         for pdf_path in pdf_files:
-            print("\n" + "#" * 60)
-            extract_and_embed_pdf(str(pdf_path), "/app/embeddings")
-            print("#" * 60 + "\n")
+            if is_up_to_date(pdf_path, "/app/embeddings"):
+                print(f"  ✓ Skipping {pdf_path.name} (embeddings are up to date)")
+            else:
+                pending_files.append(pdf_path)
+        pdf_files = pending_files
+        if not pdf_files:
+            print("All PDFs are already embedded")
+            return
+        
+        # Load the model once and share it across all PDFs
+        model, processor, device = load_model()
+        
+        # Process all PDFs, rendering the next one while the current one is embedded
+        with ThreadPoolExecutor(max_workers=1) as renderer:
+            next_pages = renderer.submit(render_pdf, str(pdf_files[0]))
+            for i, pdf_path in enumerate(pdf_files):
+                pages_future = next_pages
+                if i + 1 < len(pdf_files):
+                    next_pages = renderer.submit(render_pdf, str(pdf_files[i + 1]))
+                print("\n" + "#" * 60)
+                extract_and_embed_pdf(str(pdf_path), "/app/embeddings", model, processor, device, pages_future)
+                print("#" * 60 + "\n")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -9,13 +9,48 @@ import sys
 import requests
 import json
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Reuse one keep-alive connection for every request instead of reconnecting per call
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=8, max_retries=Retry(total=3, backoff_factor=0.3))
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
+
+# Supported image extensions and their upload content types
+IMAGE_CONTENT_TYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.bmp': 'image/bmp',
+    '.tiff': 'image/tiff',
+    '.webp': 'image/webp'
+}
+
+def to_json(data):
+    """Pretty-print data as JSON, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(data, indent=2)
+
+def parse_json(response):
+    """Decode a JSON response body, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
 
 def test_health(base_url):
     """Test health endpoint"""
     print("Testing /health endpoint...")
-    response = requests.get(f"{base_url}/health")
+    response = SESSION.get(f"{base_url}/health")
     print(f"Status: {response.status_code}")
-    print(f"Response: {json.dumps(response.json(), indent=2)}")
+    print(f"Response: {to_json(parse_json(response))}")
     return response.status_code == 200
 
 def test_ingest_pdf(base_url, pdf_path):
@@ -28,12 +63,12 @@ def test_ingest_pdf(base_url, pdf_path):
 
     with open(pdf_path, 'rb') as f:
         files = {'file': (Path(pdf_path).name, f, 'application/pdf')}
-        response = requests.post(f"{base_url}/ingest/pdf", files=files)
+        response = SESSION.post(f"{base_url}/ingest/pdf", files=files)
 
     print(f"Status: {response.status_code}")
     if response.status_code == 200:
-        data = response.json()
-        print(f"Response: {json.dumps(data, indent=2)}")
+        data = parse_json(response)
+        print(f"Response: {to_json(data)}")
         return data['document_id']
     else:
         print(f"Error: {response.text}")
@@ -49,24 +84,16 @@ def test_ingest_image(base_url, image_path):
 
     # Determine content type
     ext = Path(image_path).suffix.lower()
-    content_types = {
-        '.png': 'image/png',
-        '.jpg': 'image/jpeg',
-        '.jpeg': 'image/jpeg',
-        '.bmp': 'image/bmp',
-        '.tiff': 'image/tiff',
-        '.webp': 'image/webp'
-    }
-    content_type = content_types.get(ext, 'application/octet-stream')
+    content_type = IMAGE_CONTENT_TYPES.get(ext, 'application/octet-stream')
 
     with open(image_path, 'rb') as f:
         files = {'file': (Path(image_path).name, f, content_type)}
-        response = requests.post(f"{base_url}/ingest/image", files=files)
+        response = SESSION.post(f"{base_url}/ingest/image", files=files)
 
     print(f"Status: {response.status_code}")
     if response.status_code == 200:
-        data = response.json()
-        print(f"Response: {json.dumps(data, indent=2)}")
+        data = parse_json(response)
+        print(f"Response: {to_json(data)}")
         return data['document_id']
     else:
         print(f"Error: {response.text}")
@@ -75,11 +102,11 @@ def test_ingest_image(base_url, image_path):
 def test_list_documents(base_url):
     """Test listing documents"""
     print("\nTesting /documents endpoint...")
-    response = requests.get(f"{base_url}/documents")
+    response = SESSION.get(f"{base_url}/documents")
     print(f"Status: {response.status_code}")
     if response.status_code == 200:
-        data = response.json()
-        print(f"Response: {json.dumps(data, indent=2)}")
+        data = parse_json(response)
+        print(f"Response: {to_json(data)}")
         return data
     else:
         print(f"Error: {response.text}")
@@ -88,17 +115,17 @@ def test_list_documents(base_url):
 def test_stats(base_url):
     """Test stats endpoint"""
     print("\nTesting /stats endpoint...")
-    response = requests.get(f"{base_url}/stats")
+    response = SESSION.get(f"{base_url}/stats")
     print(f"Status: {response.status_code}")
-    print(f"Response: {json.dumps(response.json(), indent=2)}")
+    print(f"Response: {to_json(parse_json(response))}")
     return response.status_code == 200
 
 def test_delete_document(base_url, document_id):
     """Test document deletion"""
     print(f"\nTesting DELETE /document/{document_id} endpoint...")
-    response = requests.delete(f"{base_url}/document/{document_id}")
+    response = SESSION.delete(f"{base_url}/document/{document_id}")
     print(f"Status: {response.status_code}")
-    print(f"Response: {json.dumps(response.json(), indent=2)}")
+    print(f"Response: {to_json(parse_json(response))}")
     return response.status_code == 200
 
 def main():
@@ -126,7 +153,7 @@ def main():
         ext = Path(file_path).suffix.lower()
         if ext == '.pdf':
             document_id = test_ingest_pdf(base_url, file_path)
-        elif ext in ['.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp']:
+        elif ext in IMAGE_CONTENT_TYPES:
             document_id = test_ingest_image(base_url, file_path)
         else:
             print(f"\nUnsupported file type: {ext}")